@@ -2,7 +2,11 @@ import os
 import argparse
 import libtorrent as lt
 import time
+import hashlib
+import threading
+import shutil
 import subprocess
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal, pyqtSlot
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QLabel, QPushButton,
     QListWidget, QLineEdit, QFileDialog, QMessageBox
@@ -19,14 +23,69 @@ def setup_firewall():
 
 
 
+_scan_cache: dict[tuple, bool] = {}
+
+
+def _fingerprint(path: str) -> str:
+    """Hash the path, size and mtime of every file under a path."""
+    entries = []
+    if os.path.isfile(path):
+        st = os.stat(path)
+        entries.append((path, st.st_size, st.st_mtime_ns))
+    else:
+        stack = [path]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        entries.append((entry.path, st.st_size, st.st_mtime_ns))
+    h = hashlib.blake2b(digest_size=16)
+    for entry in sorted(entries):
+        h.update(repr(entry).encode())
+    return h.hexdigest()
+
+
 def scan_path(path: str) -> bool:
-    """Recursively scan a path with clamscan."""
+    """Scan a path, reusing the verdict if no file under it has changed."""
+    try:
+        key = (os.path.abspath(path), _fingerprint(path))
+    except OSError:
+        # Unreadable or missing; let the scanner report on it, uncached.
+        key = None
+    if key in _scan_cache:
+        return _scan_cache[key]
+    code = _run_scan(path)
+    if code is None:
+        return True
+    # Only 0 (clean) and 1 (virus found) are verdicts; other codes are
+    # scanner errors and are retried on the next call.
+    if key is not None and code in (0, 1):
+        _scan_cache[key] = code == 0
+    return code == 0
+
+
+def _run_scan(path: str) -> int | None:
+    """Scan a path recursively and return the scanner's exit code.
+
+    Prefers clamd over a fresh clamscan; returns None if neither is installed.
+    """
+    if shutil.which('clamdscan'):
+        # clamd keeps the signature database loaded; exit code 2 means the
+        # daemon could not be reached, so fall back to clamscan.
+        result = subprocess.run(['clamdscan', '--no-summary', '--fdpass', path],
+                                capture_output=True, text=True)
+        if result.returncode != 2:
+            return result.returncode
+        print('clamd not reachable, falling back to clamscan')
     try:
         result = subprocess.run(['clamscan', '-r', path], capture_output=True, text=True)
-        return result.returncode == 0
+        return result.returncode
     except FileNotFoundError:
         print("clamscan not found. skipping scan")
-        return True
+        return None
 
 
 def create_torrent(folder):
@@ -49,22 +108,64 @@ def share_folder(ses, folder):
     h = ses.add_torrent({'ti': info, 'save_path': folder})
     magnet = lt.make_magnet_uri(info)
     print(f"Sharing {folder}\nMagnet: {magnet}")
-    return h
+    return h, magnet
+
 
+def download_magnet(ses, magnet, out_dir, stop=None):
+    """Download a magnet into out_dir and return the downloaded path.
 
-def download_magnet(ses, magnet, out_dir):
+    If the optional threading.Event ``stop`` is set, the torrent is removed
+    and None is returned.
+    """
     params = {'save_path': out_dir, 'storage_mode': lt.storage_mode_t.storage_mode_sparse}
     handle = lt.add_magnet_uri(ses, magnet, params)
     print('Downloading metadata...')
-    while not handle.has_metadata():
-        time.sleep(1)
-    info = handle.get_torrent_info()
-    print('Starting download...')
-    while handle.status().state != lt.torrent_status.seeding:
+    finished = False
+    while not finished:
+        # Wakes as soon as an alert is posted; the timeout only paces progress output.
+        ses.wait_for_alert(1000)
+        if stop is not None and stop.is_set():
+            ses.remove_torrent(handle)
+            print('\nDownload cancelled')
+            return None
+        for a in ses.pop_alerts():
+            if not isinstance(a, lt.torrent_alert) or a.handle != handle:
+                continue
+            if isinstance(a, lt.metadata_received_alert):
+                print('Starting download...')
+            elif isinstance(a, lt.torrent_finished_alert):
+                finished = True
         s = handle.status()
-        print(f"{s.progress*100:.2f}% complete\r", end='')
-        time.sleep(1)
+        if s.state == lt.torrent_status.seeding:
+            finished = True
+        elif s.has_metadata:
+            print(f"{s.progress*100:.2f}% complete\r", end='')
     print('\nDownload complete')
+    return os.path.join(out_dir, handle.status().name)
+
+
+class WorkerSignals(QObject):
+    finished = pyqtSignal(object)
+    error = pyqtSignal(object)
+
+
+class Worker(QRunnable):
+    """Run a blocking callable on the Qt thread pool."""
+
+    def __init__(self, fn, *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.signals = WorkerSignals()
+
+    def run(self):
+        # An exception escaping QRunnable.run aborts the process under PyQt6.
+        try:
+            result = self.fn(*self.args)
+        except Exception as exc:
+            self.signals.error.emit(exc)
+        else:
+            self.signals.finished.emit(result)
 
 
 class ShareWindow(QWidget):
@@ -76,9 +177,14 @@ class ShareWindow(QWidget):
         self.ses.listen_on(6881, 6891)
         self.ses.add_dht_router('router.bittorrent.com', 6881)
         self.ses.start_dht()
-        setup_firewall()
+        mask = self.ses.get_settings()['alert_mask']
+        self.ses.apply_settings({'alert_mask': mask | lt.alert.category_t.status_notification})
+        # ufw can take a while; don't hold up the window appearing.
+        self.run_in_background(setup_firewall)
 
         self.dir = None
+        # Set on close so a running download returns and the pool can shut down.
+        self.stop_event = threading.Event()
 
         layout = QVBoxLayout(self)
         self.dir_label = QLabel('No directory selected')
@@ -91,20 +197,24 @@ class ShareWindow(QWidget):
         self.car_list = QListWidget()
         layout.addWidget(self.car_list)
 
-        btn_share = QPushButton('Share Selected Car')
-        btn_share.clicked.connect(self.share_selected)
-        layout.addWidget(btn_share)
+        self.btn_share = QPushButton('Share Selected Car')
+        self.btn_share.clicked.connect(self.share_selected)
+        layout.addWidget(self.btn_share)
 
         layout.addWidget(QLabel('Magnet link to download:'))
         self.magnet_edit = QLineEdit()
         layout.addWidget(self.magnet_edit)
-        btn_download = QPushButton('Download Magnet')
-        btn_download.clicked.connect(self.download_selected)
-        layout.addWidget(btn_download)
+        self.btn_download = QPushButton('Download Magnet')
+        self.btn_download.clicked.connect(self.download_selected)
+        layout.addWidget(self.btn_download)
 
         self.status = QLabel('')
         layout.addWidget(self.status)
 
+    def closeEvent(self, event):
+        self.stop_event.set()
+        super().closeEvent(event)
+
     def choose_dir(self):
         directory = QFileDialog.getExistingDirectory(self, 'Select Setup Directory')
         if directory:
@@ -112,14 +222,40 @@ class ShareWindow(QWidget):
             self.dir_label.setText(directory)
             self.refresh_cars()
 
+    def run_in_background(self, fn, *args, on_done=None, on_error=None):
+        worker = Worker(fn, *args)
+        if on_done is not None:
+            worker.signals.finished.connect(on_done)
+        worker.signals.error.connect(on_error or self.show_error)
+        QThreadPool.globalInstance().start(worker)
+
+    def start_job(self, fn, *args, on_done):
+        """Run a share or download job, one at a time."""
+        self.set_busy(True)
+        self.run_in_background(fn, *args, on_done=on_done, on_error=self.job_failed)
+
+    def set_busy(self, busy):
+        self.btn_share.setEnabled(not busy)
+        self.btn_download.setEnabled(not busy)
+
+    @pyqtSlot(object)
+    def show_error(self, exc):
+        QMessageBox.warning(self, 'Error', str(exc))
+
+    @pyqtSlot(object)
+    def job_failed(self, exc):
+        self.set_busy(False)
+        self.status.setText('')
+        self.show_error(exc)
+
     def refresh_cars(self):
         self.car_list.clear()
         if not self.dir:
             return
-        for car in os.listdir(self.dir):
-            car_path = os.path.join(self.dir, car)
-            if os.path.isdir(car_path):
-                self.car_list.addItem(car)
+        with os.scandir(self.dir) as it:
+            for entry in it:
+                if entry.is_dir():
+                    self.car_list.addItem(entry.name)
 
     def share_selected(self):
         if not self.dir:
@@ -131,11 +267,22 @@ class ShareWindow(QWidget):
             return
         car = items[0].text()
         path = os.path.join(self.dir, car)
-        if scan_path(path):
-            handle = share_folder(self.ses, path)
-            magnet = lt.make_magnet_uri(handle.get_torrent_info())
+        self.status.setText(f'Scanning {car}...')
+        self.start_job(self.scan_for_share, car, path, on_done=self.share_scanned)
+
+    def scan_for_share(self, car, path):
+        """Scan a car folder before sharing; runs on the thread pool."""
+        return car, path, scan_path(path)
+
+    @pyqtSlot(object)
+    def share_scanned(self, result):
+        self.set_busy(False)
+        car, path, clean = result
+        if clean:
+            _, magnet = share_folder(self.ses, path)
             self.status.setText(f'Sharing {car}: {magnet}')
         else:
+            self.status.setText('')
             QMessageBox.warning(self, 'Virus detected', 'Share aborted.')
 
     def download_selected(self):
@@ -146,10 +293,30 @@ class ShareWindow(QWidget):
         if not magnet:
             QMessageBox.warning(self, 'No magnet', 'Enter a magnet link.')
             return
-        if scan_path(self.dir):
-            download_magnet(self.ses, magnet, self.dir)
-            scan_path(self.dir)
+        self.status.setText('Scanning and downloading...')
+        self.start_job(
+            self.scan_and_download, magnet, self.dir, on_done=self.download_finished
+        )
+
+    def scan_and_download(self, magnet, out_dir):
+        """Scan, download and rescan; runs on the thread pool."""
+        if not scan_path(out_dir):
+            return False
+        path = download_magnet(self.ses, magnet, out_dir, stop=self.stop_event)
+        if path is None:
+            return None
+        scan_path(path)
+        return True
+
+    @pyqtSlot(object)
+    def download_finished(self, ok):
+        self.set_busy(False)
+        if ok is None:
+            return
+        if ok:
+            self.status.setText('Download complete')
         else:
+            self.status.setText('')
             QMessageBox.warning(self, 'Virus detected', 'Download aborted.')
 
 
@@ -173,27 +340,33 @@ def main():
     ses.listen_on(6881, 6891)
     ses.add_dht_router("router.bittorrent.com", 6881)
     ses.start_dht()
+    mask = ses.get_settings()['alert_mask']
+    ses.apply_settings({'alert_mask': mask | lt.alert.category_t.status_notification})
     setup_firewall()
 
     if args.download:
         if scan_path(args.dir):
-            download_magnet(ses, args.download, args.dir)
-            scan_path(args.dir)
+            scan_path(download_magnet(ses, args.download, args.dir))
         else:
             print('Download aborted due to virus detection')
         return
 
-    for car in os.listdir(args.dir):
-        car_path = os.path.join(args.dir, car)
-        if not os.path.isdir(car_path):
-            continue
+    with os.scandir(args.dir) as it:
+        cars = [(e.name, e.path) for e in it if e.is_dir()]
+    folders = []
+    for car, car_path in cars:
         share_path = input(f"Share entire folder for {car}? (y/n)")
         if share_path.lower().startswith('y'):
             folder = car_path
         else:
             folder = os.path.join(car_path, 'share')
             os.makedirs(folder, exist_ok=True)
-        if scan_path(folder):
+        folders.append(folder)
+    # Scan once all prompts are answered, right before sharing; only rescan
+    # per folder to find the culprit.
+    all_clean = scan_path(args.dir)
+    for folder in folders:
+        if all_clean or scan_path(folder):
             share_folder(ses, folder)
         else:
             print(f"Virus found in {folder}, skipping")